@@ -7,6 +7,7 @@ format currently include CSV and JSON.
 Usage:
   process_journal_stats.py all [-m METADATA] [options]
   process_journal_stats.py dbinsert DB_NAME [-m METADATA] [options]
+  process_journal_stats.py dbbatch DB_NAME MANIFEST [-m METADATA] [options]
   process_journal_stats.py activity [-s STATS] [options]
 
 Options:
@@ -18,6 +19,9 @@ Options:
   -s STATS           list of metadata to include with activity statistics (e.g. count share-scope keep mime_type)
   --server URL       the database server [default: http://127.0.0.1:5984]
   --deployment NAME  the deployment site
+  --jobs N           number of deployments to scan at once [default: 4]
+  --batch-size N     documents per bulk database request [default: 500]
+  --in-flight N      bulk requests to keep in flight at once [default: 4]
   --version          show version
 
 """
@@ -29,12 +33,17 @@ __version__ = "0.2"
 
 import os
 import re
+import sys
 import csv
 import ast
 import json
 import filecmp
+import threading
 import couchdb
-from couchdb.http import PreconditionFailed
+from couchdb.http import PreconditionFailed, ResourceConflict
+from Queue import Empty
+from multiprocessing import Process, Queue
+from multiprocessing.pool import ThreadPool
 from uuid import uuid4
 from docopt import docopt
 from datetime import datetime
@@ -387,20 +396,19 @@ def _get_num_devices(root_dir):
     return num_devices
 
 
-def _process_journals(root_dir):
+def _iter_journals(root_dir):
     '''
-    Output stats from all specified journals in JSON
+    Yield stats from all specified journals one activity instance at a time
 
     Input:
       root_dir, the backup root directory containing XO serial number dirs
 
     Output:
-      all_journals_stats, a list of dictionaries each containing
-                          metadata for one activity instance
+      a generator of dictionaries each containing metadata for one activity
+      instance
     '''
 
     global metadata
-    all_journals_stats = []
     dirnames_regex = _get_dirnames_regex()
 
     sugar_version = _get_sugar_version(root_dir, dirnames_regex)
@@ -412,7 +420,8 @@ def _process_journals(root_dir):
             for metadata_path in metadata_paths:
                 current_journal_stats = _process_metadata_files(metadata_path,
                                                                 sugar_version)
-                all_journals_stats += current_journal_stats
+                for instance_stats in current_journal_stats:
+                    yield instance_stats
     elif sugar_version == 0.96:
         # additional metadata is available in Sugar 0.96 datastore
         metadata = ast.literal_eval(metadata)
@@ -424,11 +433,24 @@ def _process_journals(root_dir):
             for metadata_path in metadata_paths:
                 current_journal_stats = _get_metadata_96(metadata_path)
                 if current_journal_stats:
-                    all_journals_stats.append(current_journal_stats)
+                    yield current_journal_stats
     else:
         print "The datastore format of this Sugar version is currently not supported."
 
-    return all_journals_stats
+
+def _process_journals(root_dir):
+    '''
+    Output stats from all specified journals in JSON
+
+    Input:
+      root_dir, the backup root directory containing XO serial number dirs
+
+    Output:
+      all_journals_stats, a list of dictionaries each containing
+                          metadata for one activity instance
+    '''
+
+    return list(_iter_journals(root_dir))
 
 
 def _preprocess_record(record):
@@ -545,40 +567,81 @@ def prepare_json(instance_stats, deployment):
     return instance_stats, instance_id
 
 
-def insert_into_db(collected_stats, db_name, server_url, deployment,
-                   num_devices):
+def _get_db(server_url, db_name, source):
     '''
-    Insert collected statistics into CouchDB one activity instance per
-    document
+    Open the database, creating it if it doesn't exist
     '''
 
     couch = couchdb.Server(url=server_url)
 
-    # create a new database if it doesn't exist
     try:
         db = couch.create(db_name)
     except PreconditionFailed:
         db = couch[db_name]
-        print "Importing documents from %s into existing database %s." % (deployment, db_name)
+        print "Importing documents from %s into existing database %s." % (source, db_name)
 
-    # updated the list of deployments in the db
-    deployments_doc = db.get("deployments")
-    if deployments_doc is not None:
-        if deployment not in deployments_doc["deployments"]:
-            deployments_doc["deployments"].append(deployment)
-    else:
-        deployments_doc = {"_id": "deployments",
-                           "deployments": [deployment]}
-    db.save(deployments_doc)
-
-    # update the number of devices per deployment
-    devices_doc = db.get("number of devices")
-    if devices_doc is not None:
-        devices_doc[deployment] = num_devices
-    else:
-        devices_doc = {"_id": "number of devices",
-                       deployment: num_devices}
-    db.save(devices_doc)
+    return db
+
+
+def _save_merged(db, doc_id, merge, retries=5):
+    '''
+    Apply merge to the current version of a shared document and save it,
+    re-reading the document and merging again if another import saved it
+    in the meantime.
+
+    Input:
+      doc_id, the id of the document to update
+      merge, a function which updates the document dictionary in place
+      retries, the number of attempts before the conflict is re-raised
+    '''
+
+    for attempt in range(retries):
+        doc = db.get(doc_id)
+        if doc is None:
+            doc = {"_id": doc_id}
+        merge(doc)
+        try:
+            db.save(doc)
+        except ResourceConflict:
+            if attempt == retries - 1:
+                raise
+        else:
+            return doc
+
+
+def _merge_bookkeeping(db, num_devices):
+    '''
+    Record deployments in the "deployments" document and their device counts
+    in the "number of devices" document.
+
+    Input:
+      num_devices, a dictionary mapping deployment name to number of devices
+    '''
+
+    def merge_deployments(doc):
+        deployments = doc.setdefault("deployments", [])
+        for deployment in sorted(num_devices):
+            if deployment not in deployments:
+                deployments.append(deployment)
+
+    def merge_devices(doc):
+        doc.update(num_devices)
+
+    _save_merged(db, "deployments", merge_deployments)
+    _save_merged(db, "number of devices", merge_devices)
+
+
+def insert_into_db(collected_stats, db_name, server_url, deployment,
+                   num_devices):
+    '''
+    Insert collected statistics into CouchDB one activity instance per
+    document
+    '''
+
+    db = _get_db(server_url, db_name, deployment)
+
+    # update the list of deployments and the number of devices per deployment
+    _merge_bookkeeping(db, {deployment: num_devices})
 
     count = 0
     for instance_stats in collected_stats:
@@ -603,6 +666,250 @@ def insert_into_db(collected_stats, db_name, server_url, deployment,
     print "%s Journal records inserted into db: %s" % (count, db_name)
 
 
+def _read_manifest(manifest_path):
+    '''
+    Read the list of deployments to import in batch mode.
+
+    Input:
+      manifest_path, a CSV file with one "deployment,backup directory" pair
+                     per line; blank lines and lines starting with # are
+                     skipped
+
+    Output:
+      manifest, a list of (deployment, backup_dir) tuples
+    '''
+
+    manifest = []
+    with open(manifest_path, "r") as fp:
+        for row in csv.reader(fp):
+            if not row or row[0].strip().startswith('#'):
+                continue
+            if len(row) != 2:
+                print "Skipping malformed manifest line: %s" % ','.join(row)
+                continue
+            deployment, backup_dir = [field.strip() for field in row]
+            if not os.path.isdir(backup_dir):
+                print "Skipping %s: backup directory %s not found" % (deployment, backup_dir)
+                continue
+            manifest.append((deployment, backup_dir))
+
+    return manifest
+
+
+def _scan_worker(tasks, results, metadata_arg, batch_size):
+    '''
+    Scan deployments taken from the tasks queue until a None task arrives.
+    Journal records are put on the results queue in chunks of batch_size as
+    they are read, and each deployment ends with a "done" message carrying
+    the number of records and the set of XO serial number dirs or a
+    "failed" message with the error.
+    The metadata selection is reset before each scan since scanning Sugar
+    0.96 backups changes it.
+
+    Input:
+      tasks, a queue of (deployment, backup_dir) tuples
+      results, a queue of (kind, deployment, payload) messages
+      metadata_arg, the metadata selection given on the command line
+      batch_size, the number of records per chunk
+    '''
+
+    global metadata
+    serial_num = _get_dirnames_regex()['serial_num']
+
+    for deployment, backup_dir in iter(tasks.get, None):
+        metadata = metadata_arg
+        count = 0
+        try:
+            # fails early on an unreadable backup dir, before any records
+            serials = set(serial_dir for serial_dir in os.listdir(backup_dir)
+                          if serial_num.match(serial_dir))
+
+            chunk = []
+            for instance_stats in _iter_journals(backup_dir):
+                chunk.append(instance_stats)
+                if len(chunk) == batch_size:
+                    results.put(('records', deployment, chunk))
+                    count += len(chunk)
+                    chunk = []
+            if chunk:
+                results.put(('records', deployment, chunk))
+                count += len(chunk)
+        except Exception as e:
+            results.put(('failed', deployment, str(e)))
+        else:
+            results.put(('done', deployment, (count, serials)))
+
+
+def _insert_batch(db, batch, retries=5):
+    '''
+    Insert a batch of prepared documents with one bulk request, updating
+    documents which already exist in the database. As in insert_into_db,
+    the last of several documents with the same id is the one saved.
+    Documents which conflict with a concurrent update are retried with
+    their current revision.
+
+    Output:
+      saved, the set of ids of the documents saved
+    '''
+
+    docs = dict((doc['_id'], doc) for doc in batch)
+    saved = set()
+    for attempt in range(retries):
+        revs = {}
+        for row in db.view('_all_docs', keys=docs.keys()):
+            value = row.get('value')
+            if value is not None:
+                revs[row['key']] = value['rev']
+
+        for doc_id, doc in docs.items():
+            if doc_id in revs:
+                doc['_rev'] = revs[doc_id]
+            else:
+                doc.pop('_rev', None)
+
+        conflicts = {}
+        for success, doc_id, result in db.update(docs.values()):
+            if success:
+                saved.add(doc_id)
+            elif isinstance(result, ResourceConflict):
+                conflicts[doc_id] = docs[doc_id]
+            else:
+                print "Could not insert document %s: %s" % (doc_id, result)
+
+        docs = conflicts
+        if not docs:
+            break
+
+    for doc_id in docs:
+        print "Could not insert document %s: it kept conflicting with other updates" % doc_id
+
+    return saved
+
+
+def insert_batches_into_db(manifest, db_name, server_url, jobs, batch_size,
+                           in_flight):
+    '''
+    Scan the backups of several deployments concurrently and stream their
+    records into CouchDB in bulk batches while they are being scanned. The
+    shared "deployments" and "number of devices" documents are updated once
+    all records have been inserted, only for deployments which were scanned
+    successfully.
+
+    Input:
+      manifest, a list of (deployment, backup_dir) tuples
+      jobs, the number of deployments to scan at once
+      batch_size, the number of documents per bulk request
+      in_flight, the maximum number of bulk requests running at once
+
+    Output:
+      failed, a sorted list of deployments which could not be imported
+    '''
+
+    global metadata
+
+    deployments = set(deployment for deployment, backup_dir in manifest)
+    db = _get_db(server_url, db_name, "%s deployments" % len(deployments))
+
+    jobs = min(jobs, len(manifest))
+    tasks = Queue()
+    for deployment, backup_dir in manifest:
+        tasks.put((deployment, backup_dir))
+    for _ in range(jobs):
+        tasks.put(None)
+    # a bounded queue makes the scanners wait while the uploads catch up
+    results = Queue(maxsize=jobs + in_flight)
+    scanners = [Process(target=_scan_worker,
+                        args=(tasks, results, metadata, batch_size))
+                for _ in range(jobs)]
+    for scanner in scanners:
+        scanner.start()
+
+    upload_pool = ThreadPool(processes=in_flight)
+    slots = threading.BoundedSemaphore(in_flight)
+    uploads = []
+    serials = {}
+    scan_failures = {}
+
+    def upload(batch):
+        try:
+            return _insert_batch(db, batch)
+        finally:
+            slots.release()
+
+    def submit(deployment, batch):
+        slots.acquire()
+        uploads.append((deployment, upload_pool.apply_async(upload, (batch,))))
+
+    # scans still expected per deployment, which may be listed repeatedly
+    pending = {}
+    for deployment, backup_dir in manifest:
+        pending[deployment] = pending.get(deployment, 0) + 1
+    remaining = len(manifest)
+    try:
+        while remaining:
+            try:
+                kind, deployment, payload = results.get(timeout=1)
+            except Empty:
+                if not any(scanner.is_alive() for scanner in scanners):
+                    print "Scan workers exited before finishing the manifest."
+                    break
+                continue
+
+            if kind == 'records':
+                submit(deployment, [prepare_json(instance_stats, deployment)[0]
+                                    for instance_stats in payload])
+            elif kind == 'done':
+                records, deployment_serials = payload
+                print "Scanned %s: %s Journal records from %s devices" % (deployment, records, len(deployment_serials))
+                # a deployment may be listed once per schoolserver dump, and
+                # an XO backed up on several of them is still one device
+                serials.setdefault(deployment, set()).update(deployment_serials)
+                pending[deployment] -= 1
+                remaining -= 1
+            else:
+                print "Could not scan %s: %s" % (deployment, payload)
+                scan_failures[deployment] = payload
+                pending[deployment] -= 1
+                remaining -= 1
+    finally:
+        for scanner in scanners:
+            if remaining:
+                scanner.terminate()
+            scanner.join()
+        # some of their records may have been uploaded already
+        for deployment in pending:
+            if pending[deployment]:
+                scan_failures.setdefault(deployment, "scan worker exited")
+        upload_pool.close()
+        upload_pool.join()
+
+        # a record may be saved more than once when dumps overlap
+        saved = {}
+        upload_failures = {}
+        for deployment, result in uploads:
+            try:
+                saved.setdefault(deployment, set()).update(result.get())
+            except Exception as e:
+                upload_failures.setdefault(deployment, str(e))
+
+        # records of a deployment which failed partway may already be in
+        # the db, but it is left out of the bookkeeping documents
+        num_devices = dict((deployment, len(serials[deployment]))
+                           for deployment in serials
+                           if deployment not in scan_failures
+                           and deployment not in upload_failures)
+        _merge_bookkeeping(db, num_devices)
+
+    for deployment in sorted(num_devices):
+        print "%s Journal records from %s inserted into db: %s" % (len(saved.get(deployment, ())), deployment, db_name)
+    for deployment in sorted(upload_failures):
+        print "Could not insert records from %s: %s" % (deployment, upload_failures[deployment])
+    if scan_failures:
+        print "Deployments which could not be scanned: %s" % ', '.join(sorted(scan_failures))
+
+    return sorted(set(scan_failures) | set(upload_failures))
+
+
 def main():
     arguments = docopt(__doc__, version=__version__)
     backup_dir = arguments['-d']
@@ -652,6 +959,32 @@ def main():
         # put collected stats into CouchDB
         insert_into_db(collected_stats, db_name, server_url, deployment, num_devices)
 
+    elif arguments['dbbatch']:
+        metadata = arguments['-m']
+        db_name = arguments['DB_NAME']
+        server_url = arguments['--server']
+
+        limits = {}
+        for option in ('--jobs', '--batch-size', '--in-flight'):
+            try:
+                limits[option] = int(arguments[option])
+            except ValueError:
+                limits[option] = 0
+            if limits[option] < 1:
+                print "%s must be a positive integer, got %s" % (option, arguments[option])
+                return
+
+        manifest = _read_manifest(arguments['MANIFEST'])
+        if not manifest:
+            print "No deployments found in manifest %s" % arguments['MANIFEST']
+            return
+        failed = insert_batches_into_db(manifest, db_name, server_url,
+                                        limits['--jobs'],
+                                        limits['--batch-size'],
+                                        limits['--in-flight'])
+        if failed:
+            sys.exit(1)
+
     elif arguments['activity']:
         metadata = arguments['-s']
         metadata = metadata.split(',') if metadata else []